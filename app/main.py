@@ -1,5 +1,6 @@
 from fastapi import FastAPI, HTTPException, Depends, status
-from pymongo import MongoClient
+from pymongo import AsyncMongoClient
+from pymongo.errors import DuplicateKeyError, PyMongoError
 from pydantic import BaseModel
 from typing import List, Optional
 from bson import ObjectId
@@ -7,29 +8,63 @@ import os
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
 from passlib.context import CryptContext
-from datetime import datetime, timedelta
-from jose import JWTError, jwt
+from datetime import timedelta
+from jose import JWTError, jwk, jwt
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 import requests  # for image URL validation
 import uvicorn
+import asyncio
 from fastapi.responses import FileResponse
+from contextlib import asynccontextmanager
+from cachetools import TTLCache
+import hashlib
+import threading
+import time
+import logging
 
 
 
+logger = logging.getLogger(__name__)
+
 # Load environment variables
 load_dotenv()
 MONGODB_URI = os.getenv("MONGODB_URI")
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# Idle connections kept open per instance; raise it on long-lived hosts, keep it low on serverless
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
 
 # Connect to MongoDB Atlas
-client = MongoClient(MONGODB_URI)
+client = AsyncMongoClient(MONGODB_URI, minPoolSize=MONGO_MIN_POOL_SIZE, maxPoolSize=50, maxIdleTimeMS=60000)
 db = client["supercook"]
 users_collection = db["users"]
 favorites_collection = db["favorite_recipes"]
 
-app = FastAPI()
+# Unique indexes confirmed to exist. Until one is, writes to that collection
+# keep their lookup-before-insert guard (e.g. the index build failed on existing
+# duplicates, or the platform never ran the lifespan handler).
+_unique_indexes = {"users": False, "favorites": False}
+
+async def ensure_unique_index(name, collection, keys):
+    try:
+        await collection.create_index(keys, unique=True)
+    except PyMongoError:
+        logger.exception("Could not build unique index on %s, keeping lookup checks before inserts", name)
+        return
+    _unique_indexes[name] = True
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open pooled connections before the first request needs them
+    await client.admin.command("ping")
+    # The (email, name) index also serves the per-user favorites queries
+    await ensure_unique_index("users", users_collection, "email")
+    await ensure_unique_index("favorites", favorites_collection, [("email", 1), ("name", 1)])
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 # Allow frontend to access API
 app.add_middleware(
@@ -41,51 +76,102 @@ app.add_middleware(
 )
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 # OAuth2 authentication
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 
+# Build the HMAC key and decode settings once instead of on every token
+_jwt_key = jwk.construct(SECRET_KEY, ALGORITHM)
+_jwt_algorithms = [ALGORITHM]
+_jwt_decode_options = {"verify_signature": True, "verify_exp": True, "require_exp": True}
+
+# Cache of validated tokens: sha256(token) -> (exp, serialized user)
+# Only touched from the event loop, so it needs no lock
+_auth_cache = TTLCache(maxsize=10000, ttl=30)
+# Bumped per email on invalidation, so a lookup that raced an update or delete
+# doesn't write the stale document back into the cache
+_auth_generation = {}
+
+# Cache of image URL checks: url -> bool, filled from worker threads
+_img_cache = TTLCache(maxsize=5000, ttl=3600)
+_img_cache_lock = threading.Lock()
+_MISSING = object()
+
 # Helper functions
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+# bcrypt is deliberately slow, so run it in a worker thread to keep the event loop free
+async def verify_password(plain_password, hashed_password):
+    return await asyncio.to_thread(pwd_context.verify, plain_password, hashed_password)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await asyncio.to_thread(pwd_context.hash, password)
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
-    expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    # JWT stores exp as integer epoch seconds, so compute it directly
+    lifetime = int(expires_delta.total_seconds()) if expires_delta else ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    to_encode["exp"] = int(time.time()) + lifetime
+    return jwt.encode(to_encode, _jwt_key, algorithm=ALGORITHM)
 
 def serialize_document(doc):
     doc["id"] = str(doc["_id"])
     del doc["_id"]
     return doc
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+def invalidate_cached_user(email: str):
+    """Drop cached tokens for a user whose document changed."""
+    _auth_generation[email] = _auth_generation.get(email, 0) + 1
+    stale = [key for key, (_, user) in _auth_cache.items() if user["email"] == email]
+    for key in stale:
+        _auth_cache.pop(key, None)
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    key = hashlib.sha256(token.encode()).hexdigest()
+    cached = _auth_cache.get(key)
+    if cached:
+        exp, user = cached
+        if exp > time.time():
+            return dict(user)
+        _auth_cache.pop(key, None)
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(token, _jwt_key, algorithms=_jwt_algorithms, options=_jwt_decode_options)
         user_email: str = payload.get("sub")
         if not user_email:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
-        user = users_collection.find_one({"email": user_email})
+        generation = _auth_generation.get(user_email, 0)
+        user = await users_collection.find_one({"email": user_email}, {"password": 0})
         if not user:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-        return serialize_document(user)
+        user = serialize_document(user)
+        if _auth_generation.get(user_email, 0) == generation:
+            _auth_cache[key] = (payload["exp"], user)
+        return dict(user)
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
 
 def check_image_url(image_url: str) -> bool:
     """Check if the image URL is accessible."""
+    with _img_cache_lock:
+        cached = _img_cache.get(image_url, _MISSING)
+    if cached is not _MISSING:
+        return cached
     try:
-        response = requests.get(image_url)
-        if response.status_code == 200 and 'image' in response.headers.get('Content-Type', ''):
-            return True
-        return False
+        response = requests.head(image_url, timeout=2, allow_redirects=True)
+        if not 200 <= response.status_code < 300:
+            # Many hosts and signed-URL CDNs reject HEAD (403, 405, 501...) while GET works,
+            # so confirm with a streamed GET, which never downloads the body
+            response = requests.get(image_url, timeout=2, stream=True)
+            response.close()
     except requests.exceptions.RequestException:
+        # Network failures may be temporary, so they are not cached
         return False
+    is_image = response.status_code == 200 and response.headers.get('Content-Type', '').startswith('image/')
+    # Only cache definite answers (2xx, or 4xx other than 429); 5xx and 429 may clear up shortly
+    code = response.status_code
+    if 200 <= code < 300 or (400 <= code < 500 and code != 429):
+        with _img_cache_lock:
+            _img_cache[image_url] = is_image
+    return is_image
 
 class User(BaseModel):
     name: str
@@ -104,27 +190,30 @@ class FavoriteRecipe(BaseModel):
     instructions: str
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Welcome to the SuperCook API!"}
 
 @app.post("/users/", response_model=dict)
-def create_user(user: User):
-    if users_collection.find_one({"email": user.email}):
+async def create_user(user: User):
+    if not _unique_indexes["users"] and await users_collection.find_one({"email": user.email}, {"_id": 1}):
         raise HTTPException(status_code=400, detail="Email already registered")
     user_dict = user.dict()
-    user_dict["password"] = get_password_hash(user.password)
+    user_dict["password"] = await get_password_hash(user.password)
     # Store user in MongoDB, including the profile_image URL if provided
-    users_collection.insert_one(user_dict)
-    return {"message": "User created successfully"}
+    try:
+        result = await users_collection.insert_one(user_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    return {"id": str(result.inserted_id), "message": "User created successfully"}
 
 @app.put("/users/", response_model=dict)
-def update_user(user: User, current_user: dict = Depends(get_current_user)):
+async def update_user(user: User, current_user: dict = Depends(get_current_user)):
     # Ensure the user is the one who is logged in
     if current_user["email"] != user.email:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You can only update your own profile")
     
     # Validate the profile image URL if provided
-    if user.profile_image and not check_image_url(user.profile_image):
+    if user.profile_image and not await asyncio.to_thread(check_image_url, user.profile_image):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Provided image URL is not accessible")
     
     # Prepare the user data for update, exclude unset fields (not passed in the request)
@@ -132,10 +221,10 @@ def update_user(user: User, current_user: dict = Depends(get_current_user)):
     
     # If password is not provided in the request, keep the existing password
     if "password" in update_data:
-        update_data["password"] = get_password_hash(update_data["password"])  # Hash the new password
+        update_data["password"] = await get_password_hash(update_data["password"])  # Hash the new password
     
     # Update user data in the database
-    result = users_collection.update_one(
+    result = await users_collection.update_one(
         {"email": current_user["email"]},
         {"$set": update_data}
     )
@@ -143,27 +232,29 @@ def update_user(user: User, current_user: dict = Depends(get_current_user)):
     if result.modified_count == 0:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found or no changes made")
 
+    invalidate_cached_user(current_user["email"])
     return {"message": "Profile updated successfully"}
 
 @app.post("/token", response_model=Token)
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = users_collection.find_one({"email": form_data.username})
-    if not user or not verify_password(form_data.password, user["password"]):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+    user = await users_collection.find_one({"email": form_data.username}, {"email": 1, "password": 1})
+    if not user or not await verify_password(form_data.password, user["password"]):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid email or password")
     access_token = create_access_token(data={"sub": user["email"]})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/users/profile", response_model=dict)
-def get_user_profile(current_user: dict = Depends(get_current_user)):
+async def get_user_profile(current_user: dict = Depends(get_current_user)):
     return current_user
 
 @app.delete("/users/delete_account/", response_model=dict)
-def delete_user_account(current_user: dict = Depends(get_current_user)):
+async def delete_user_account(current_user: dict = Depends(get_current_user)):
     # Delete the user's favorite recipes first (optional, depending on your requirements)
-    favorites_collection.delete_many({"email": current_user["email"]})
+    await favorites_collection.delete_many({"email": current_user["email"]})
     
     # Delete the user from the users collection
-    result = users_collection.delete_one({"email": current_user["email"]})
+    result = await users_collection.delete_one({"email": current_user["email"]})
+    invalidate_cached_user(current_user["email"])
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
@@ -172,18 +263,22 @@ def delete_user_account(current_user: dict = Depends(get_current_user)):
 
 # Favorite Recipes Endpoints
 @app.post("/recipes/", response_model=dict)
-def add_favorite_recipe(recipe: FavoriteRecipe, current_user: dict = Depends(get_current_user)):
+async def add_favorite_recipe(recipe: FavoriteRecipe, current_user: dict = Depends(get_current_user)):
     # Add the user's email to the recipe data
     recipe_dict = recipe.dict()
     recipe_dict["email"] = current_user["email"]
     
-    # Check if the recipe already exists for the user
-    existing_recipe = favorites_collection.find_one({"email": current_user["email"], "name": recipe_dict["name"]})
-    if existing_recipe:
+    # Check if the recipe already exists for the user, unless the unique index already rejects duplicates
+    if not _unique_indexes["favorites"] and await favorites_collection.find_one(
+        {"email": current_user["email"], "name": recipe_dict["name"]}, {"_id": 1}
+    ):
         raise HTTPException(status_code=400, detail="Recipe with this title already exists for the user")
     
     # Insert the new recipe into the database
-    favorites_collection.insert_one(recipe_dict)
+    try:
+        await favorites_collection.insert_one(recipe_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Recipe with this title already exists for the user")
     return {"message": "Recipe added successfully"}
 
 @app.get("/favicon.ico", include_in_schema=False)
@@ -191,25 +286,29 @@ async def favicon():
     return FileResponse("path/to/favicon.ico")
 
 @app.get("/get_recipes/", response_model=List[dict])
-def get_user_recipes(title: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+async def get_user_recipes(title: Optional[str] = None, current_user: dict = Depends(get_current_user)):
     # Build the query based on the user's email and optional title
     query = {"email": current_user["email"]}
     if title:
         query["name"] = title  # Assuming "name" is the field for the recipe title
     
-    # Retrieve and serialize the recipes
-    recipes = [serialize_document(recipe) for recipe in favorites_collection.find(query)]
-    return recipes
+    # Retrieve the recipes, renaming _id to id on the server
+    pipeline = [
+        {"$match": query},
+        {"$project": {"_id": 0, "id": {"$toString": "$_id"}, "name": 1, "image": 1, "ingredients": 1, "instructions": 1}},
+    ]
+    cursor = await favorites_collection.aggregate(pipeline)
+    return await cursor.to_list(length=None)
 
 @app.delete("/delete_recipes/", response_model=dict)
-def delete_favorite_recipe(title: str, current_user: dict = Depends(get_current_user)):
+async def delete_favorite_recipe(title: str, current_user: dict = Depends(get_current_user)):
     # Ensure the recipe belongs to the current user before deleting
-    recipe = favorites_collection.find_one({"email": current_user["email"], "name": title})
+    recipe = await favorites_collection.find_one({"email": current_user["email"], "name": title}, {"_id": 1})
     if not recipe:
         raise HTTPException(status_code=404, detail="Recipe not found or you don't have permission to delete it")
     
     # Delete the recipe
-    favorites_collection.delete_one({"email": current_user["email"], "name": title})
+    await favorites_collection.delete_one({"email": current_user["email"], "name": title})
     return {"message": "Recipe deleted successfully"}
 
 if __name__ == "__main__":